@@ -7,11 +7,27 @@ Only responds to messages from the configured allowed user.
 import os
 import sys
 import subprocess
-import tempfile
+import shutil
 import asyncio
 import json
+import base64
+import stat
+import time
+import logging
+import logging.handlers
+import queue
+import atexit
 import datetime
+import itertools
+import traceback
+from collections import defaultdict, deque
 from pathlib import Path
+from typing import Awaitable, Callable, NamedTuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # Fix Windows console encoding
 if sys.platform == "win32":
@@ -20,6 +36,7 @@ if sys.platform == "win32":
 
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -33,12 +50,15 @@ load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ALLOWED_USERNAME = os.getenv("ALLOWED_USERNAME")
+ALLOWED_USERNAME_LC = (ALLOWED_USERNAME or "").lower()
 TELEGRAM_MAX_LENGTH = 4096
-OWNER_CHAT_ID = os.getenv("OWNER_CHAT_ID")
+# An int, so error alerts share throttled_send's per-chat slot with replies to that chat
+OWNER_CHAT_ID = int(os.getenv("OWNER_CHAT_ID")) if os.getenv("OWNER_CHAT_ID") else None
 
-# Directory for temporary images
-TEMP_DIR = Path("temp_images")
-TEMP_DIR.mkdir(exist_ok=True)
+# Webhook mode (Telegram pushes updates); polling is used when WEBHOOK_URL is unset
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8443)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
 
 # Session storage file
 SESSION_FILE = Path("session_data.json")
@@ -46,6 +66,14 @@ SESSION_FILE = Path("session_data.json")
 # Default working directory
 DEFAULT_SCOPE = os.getcwd()
 
+# File types /send uploads as photos rather than documents
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+# Image types the Claude API accepts, and its 5 MB cap on the base64-encoded data
+CLAUDE_IMAGE_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+CLAUDE_IMAGE_MAX_BYTES = 5 * 1024 * 1024
+MAX_IMAGE_SIZE = CLAUDE_IMAGE_MAX_BYTES // 4 * 3
+
 # Scope presets
 SCOPE_PRESETS = {
     "desktop": os.path.expanduser("~/Desktop"),
@@ -56,518 +84,1179 @@ SCOPE_PRESETS = {
     "root": "C:\\" if sys.platform == "win32" else "/",
 }
 
+# Preset directories are fixed, so check them once instead of on every button press
+SCOPE_PRESET_VALID = {name: os.path.isdir(path) for name, path in SCOPE_PRESETS.items()}
+
+# Idle seconds before a persistent claude process is shut down
+CLAUDE_IDLE_TIMEOUT = 120
+
+# claude executable, resolved once instead of searching PATH on every spawn
+# (on Windows this also picks up the npm claude.cmd shim)
+CLAUDE_BIN = shutil.which("claude") or "claude"
+
+# Seconds a single claude turn may run before it is stopped
+CLAUDE_TIMEOUT = 600
+
+# Stored instead of a real session id to pick up the scope's most recent conversation
+CONTINUE_LAST = "last"
+
+# Seconds a one-shot claude gets to exit after its output ends
+CLAUDE_EXIT_GRACE = 5
+
+# Max size of a single stream-json line read from claude
+CLAUDE_STREAM_LIMIT = 16 * 1024 * 1024
+
+# stderr lines kept from a persistent claude process to explain why it failed
+CLAUDE_STDERR_LINES = 20
+
+# claude and the tools it runs inherit this; NO_COLOR keeps ANSI escapes out of their output
+CLAUDE_ENV = {**os.environ, "NO_COLOR": "1"}
+CLAUDE_ENV.pop("FORCE_COLOR", None)
+
+# claude's stdout pipe capacity where it can be raised (Linux); the 64 KiB default
+# makes claude stall on long output and wakes the event loop for every small chunk
+CLAUDE_PIPE_SIZE = 1 << 20
+
+# Flags shared by every claude spawn: prompts (images included) go in as stream-json
+# messages on stdin, events come out as they happen with text deltas included
+CLAUDE_STREAM_ARGS = [
+    "--print",
+    "--input-format", "stream-json",
+    "--output-format", "stream-json",
+    "--verbose",
+    "--include-partial-messages",
+]
+
+# Minimum seconds between edits of a message showing claude's partial output
+STREAM_EDIT_INTERVAL = 1.5
+
+# Pending claude requests and the number of workers draining them
+CLAUDE_QUEUE_SIZE = 32
+CLAUDE_WORKERS = 3
+
+# Telegram allows about one message per second per chat and 30 per second overall
+CHAT_SEND_INTERVAL = 1.05
+GLOBAL_SEND_LIMIT = 25
+
+# Telegram shows "typing" for ~5s, so re-send it this often while waiting
+TYPING_INTERVAL = 4
+
+
+# In-memory session state, loaded once in main(); the file is only rewritten after a change
+SESSION_STATE: dict = {}
+_SESSION_DIRTY = False
+_SESSION_LOCK = asyncio.Lock()
+_FLUSH_TASK: asyncio.Task | None = None
+
+# Seconds to wait before flushing so a burst of changes is written once
+SESSION_FLUSH_DELAY = 0.5
+
 
 def load_session_data() -> dict:
     if SESSION_FILE.exists():
         try:
             return json.loads(SESSION_FILE.read_text(encoding='utf-8'))
-        except:
-            pass
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning("session reload failed: %s", e)
     return {"session_id": None, "scope": DEFAULT_SCOPE}
 
 
-def save_session_data(data: dict) -> None:
-    SESSION_FILE.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+def save_session_data() -> None:
+    global _SESSION_DIRTY, _FLUSH_TASK
+    _SESSION_DIRTY = True
+    if _FLUSH_TASK is None or _FLUSH_TASK.done():
+        _FLUSH_TASK = asyncio.create_task(_flush_session_data())
+        _FLUSH_TASK.add_done_callback(_flush_done)
+
+
+def _flush_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception():
+        logging.error("saving session data failed: %s", task.exception())
+
+
+def _session_payload() -> bytes:
+    """Snapshot SESSION_STATE on the event loop so the writer thread never sees it mid-change."""
+    global _SESSION_DIRTY
+    _SESSION_DIRTY = False
+    return json.dumps(SESSION_STATE, ensure_ascii=False).encode("utf-8")
+
+
+def _save_session_sync(payload: bytes) -> None:
+    # Write a sibling file and swap it in so a crash never leaves truncated JSON;
+    # fsync first so the rename can't land before the data after a power loss.
+    # Raw os calls skip the buffered text-file layer for this one small write.
+    tmp = SESSION_FILE.with_suffix(".json.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, SESSION_FILE)
+
+
+async def _flush_session_data() -> None:
+    global _SESSION_DIRTY
+    await asyncio.sleep(SESSION_FLUSH_DELAY)
+    async with _SESSION_LOCK:
+        # Loop in case the state changed again while the last write ran
+        while _SESSION_DIRTY:
+            try:
+                await asyncio.to_thread(_save_session_sync, _session_payload())
+            except BaseException:
+                # Keep the change pending for the next save or the shutdown flush
+                _SESSION_DIRTY = True
+                raise
+
+
+def setup_logging() -> None:
+    """Send log records through a queue so a background thread does the console writes."""
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, console)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    # httpx logs every Telegram API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
 
 def is_allowed_user(update: Update) -> bool:
+    if not ALLOWED_USERNAME_LC:
+        return False
     user = update.effective_user
-    if user and user.username:
-        return user.username.lower() == ALLOWED_USERNAME.lower()
-    return False
-
-
-def get_main_keyboard():
-    """Main menu keyboard."""
-    keyboard = [
-        [
-            InlineKeyboardButton("📁 Scope", callback_data="menu_scope"),
-            InlineKeyboardButton("🔄 Session", callback_data="menu_session"),
-        ],
-        [
-            InlineKeyboardButton("📊 Status", callback_data="action_status"),
-            InlineKeyboardButton("🆔 My ID", callback_data="action_myid"),
-        ],
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-
-def get_scope_keyboard():
-    """Scope presets keyboard."""
-    keyboard = [
-        [
-            InlineKeyboardButton("🖥 Desktop", callback_data="scope_desktop"),
-            InlineKeyboardButton("📄 Documents", callback_data="scope_documents"),
-        ],
-        [
-            InlineKeyboardButton("📥 Downloads", callback_data="scope_downloads"),
-            InlineKeyboardButton("🏠 Home", callback_data="scope_home"),
-        ],
-        [
-            InlineKeyboardButton("📍 Here", callback_data="scope_here"),
-            InlineKeyboardButton("💽 Root", callback_data="scope_root"),
-        ],
-        [
-            InlineKeyboardButton("🆕 New Project", callback_data="scope_new"),
-        ],
-        [
-            InlineKeyboardButton("« Back", callback_data="menu_main"),
-        ],
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-
-def get_session_keyboard():
-    """Session control keyboard."""
-    keyboard = [
-        [
-            InlineKeyboardButton("🆕 New Session", callback_data="session_clear"),
-            InlineKeyboardButton("▶️ Resume Last", callback_data="session_resume"),
-        ],
-        [
-            InlineKeyboardButton("« Back", callback_data="menu_main"),
-        ],
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-
-async def call_claude(prompt: str, image_path: str = None) -> str:
-    session_data = load_session_data()
-    scope = session_data.get("scope", DEFAULT_SCOPE)
-    session_id = session_data.get("session_id")
+    return bool(user and user.username and user.username.lower() == ALLOWED_USERNAME_LC)
+
+
+class AllowedUserFilter(filters.UpdateFilter):
+    """Let handlers see only updates from ALLOWED_USERNAME."""
+
+    def filter(self, update: Update) -> bool:
+        return is_allowed_user(update)
+
+
+ALLOWED_USER = AllowedUserFilter(name="AllowedUser")
+
+
+# Button callback_data values, shared by the keyboards and CALLBACK_HANDLERS
+CB_MENU_MAIN = "menu_main"
+CB_MENU_SCOPE = "menu_scope"
+CB_MENU_SESSION = "menu_session"
+CB_SESSION_CLEAR = "session_clear"
+CB_SESSION_RESUME = "session_resume"
+CB_ACTION_STATUS = "action_status"
+CB_ACTION_MYID = "action_myid"
+CB_SCOPE_PREFIX = "scope_"
+
+# Inline keyboards never change, so build them once
+BACK_BUTTON = InlineKeyboardButton("« Back", callback_data=CB_MENU_MAIN)
+
+MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📁 Scope", callback_data=CB_MENU_SCOPE),
+        InlineKeyboardButton("🔄 Session", callback_data=CB_MENU_SESSION),
+    ],
+    [
+        InlineKeyboardButton("📊 Status", callback_data=CB_ACTION_STATUS),
+        InlineKeyboardButton("🆔 My ID", callback_data=CB_ACTION_MYID),
+    ],
+])
+
+SCOPE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🖥 Desktop", callback_data=CB_SCOPE_PREFIX + "desktop"),
+        InlineKeyboardButton("📄 Documents", callback_data=CB_SCOPE_PREFIX + "documents"),
+    ],
+    [
+        InlineKeyboardButton("📥 Downloads", callback_data=CB_SCOPE_PREFIX + "downloads"),
+        InlineKeyboardButton("🏠 Home", callback_data=CB_SCOPE_PREFIX + "home"),
+    ],
+    [
+        InlineKeyboardButton("📍 Here", callback_data=CB_SCOPE_PREFIX + "here"),
+        InlineKeyboardButton("💽 Root", callback_data=CB_SCOPE_PREFIX + "root"),
+    ],
+    [
+        InlineKeyboardButton("🆕 New Project", callback_data=CB_SCOPE_PREFIX + "new"),
+    ],
+    [
+        BACK_BUTTON,
+    ],
+])
+
+SESSION_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🆕 New Session", callback_data=CB_SESSION_CLEAR),
+        InlineKeyboardButton("▶️ Resume Last", callback_data=CB_SESSION_RESUME),
+    ],
+    [
+        BACK_BUTTON,
+    ],
+])
+
+
+# Menu texts, filled from status_fields()
+TPL_MAIN = (
+    "🤖 *Claude Code Bot*\n\n"
+    "📁 Scope: `{scope}`\n"
+    "💬 Session: {session}\n\n"
+    "Send any message to chat with Claude."
+)
+TPL_START = TPL_MAIN + "\nUse /send <file> to get files."
+TPL_SCOPE_MENU = (
+    "📁 *Select Scope*\n\n"
+    "Current: `{scope}`\n\n"
+    "Choose a preset or use /scope <path>"
+)
+TPL_SESSION_MENU = (
+    "🔄 *Session Control*\n\n"
+    "Status: {session}\n\n"
+    "• *New Session* - start fresh\n"
+    "• *Resume Last* - continue previous"
+)
+TPL_STATUS = (
+    "📊 *Status*\n\n"
+    "📁 Scope: `{scope}`\n"
+    "💬 Session: {session}"
+)
+
+
+def status_fields() -> dict:
+    return {
+        "scope": SESSION_STATE.get("scope", DEFAULT_SCOPE),
+        "session": "active" if SESSION_STATE.get("session_id") is not None else "none",
+    }
+
+
+_TYPING_TASKS: set[asyncio.Task] = set()
+_LAST_TYPING: defaultdict = defaultdict(float)
+
+
+def send_typing(chat) -> None:
+    """Fire the typing action without waiting for Telegram to answer."""
+    # Still showing from the last one, so skip the API call
+    now = time.monotonic()
+    if now - _LAST_TYPING[chat.id] < TYPING_INTERVAL:
+        return
+    _LAST_TYPING[chat.id] = now
 
-    cmd = ["claude"]
+    task = asyncio.create_task(chat.send_action("typing"))
+    _TYPING_TASKS.add(task)
+    task.add_done_callback(_typing_done)
 
-    if session_id:
-        cmd.extend(["--continue", session_id])
 
-    if image_path:
-        cmd.extend(["--image", image_path])
+def _typing_done(task: asyncio.Task) -> None:
+    _TYPING_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.debug("typing action failed: %s", task.exception())
 
-    cmd.extend(["-p", prompt])
 
+async def readline_keepalive(stream: asyncio.StreamReader, chat=None) -> bytes:
+    """Read one line, re-sending the typing action while claude is quiet."""
+    while True:
+        try:
+            return await asyncio.wait_for(stream.readline(), timeout=TYPING_INTERVAL)
+        except asyncio.TimeoutError:
+            if chat:
+                send_typing(chat)
+
+
+def apply_stream_event(event: dict, text: str) -> str:
+    """Fold one stream-json event into the reply text streamed so far."""
+    if event.get("type") != "stream_event":
+        return text
+    inner = event.get("event", {})
+    if inner.get("type") == "message_start" and text:
+        return text + "\n\n"
+    delta = inner.get("delta", {})
+    if delta.get("type") == "text_delta":
+        return text + delta.get("text", "")
+    return text
+
+
+async def read_result(stream: asyncio.StreamReader, chat=None, on_text=None) -> dict | None:
+    """Read stream-json events up to the turn's "result", or None if the stream ends first.
+
+    on_text, if given, is awaited with the reply text so far whenever it grows.
+    """
+    text = ""
+    while True:
+        line = await readline_keepalive(stream, chat)
+        if not line:
+            return None
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if event.get("type") == "result":
+            return event
+        if on_text:
+            new_text = apply_stream_event(event, text)
+            if new_text != text:
+                text = new_text
+                await on_text(text)
+
+
+async def stop_process(process: asyncio.subprocess.Process) -> None:
+    """Terminate a process, escalating to kill if it doesn't exit promptly."""
+    if process.returncode is not None:
+        return
+    process.terminate()
     try:
+        await asyncio.wait_for(process.wait(), timeout=5)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+def user_message(prompt: str, image: bytes = None, media_type: str = "image/jpeg") -> bytes:
+    """Encode a prompt, with an optional image, as one stream-json line for claude's stdin."""
+    content = prompt
+    if image:
+        content = [
+            {
+                "type": "image",
+                "source": {"type": "base64", "media_type": media_type, "data": base64.b64encode(image).decode("ascii")},
+            },
+            {"type": "text", "text": prompt},
+        ]
+    message = {"type": "user", "message": {"role": "user", "content": content}}
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+async def spawn_claude_process(cmd: list[str], scope: str, stderr) -> tuple[asyncio.subprocess.Process, asyncio.StreamReader]:
+    """Start claude with a stdin pipe and return the process and a reader for its stdout."""
+    if not hasattr(fcntl, "F_SETPIPE_SZ"):
         process = await asyncio.create_subprocess_exec(
             *cmd,
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=stderr,
             cwd=scope,
+            env=CLAUDE_ENV,
+            limit=CLAUDE_STREAM_LIMIT,
         )
-        stdout, stderr = await process.communicate()
+        return process, process.stdout
 
-        if process.returncode != 0:
-            error_msg = stderr.decode("utf-8", errors="replace")
-            if "session" in error_msg.lower() or "continue" in error_msg.lower():
-                return await call_claude_new_session(prompt, image_path, scope)
-            return f"Error calling Claude: {error_msg}"
+    # Build the stdout pipe ourselves so its buffer can be enlarged
+    read_fd, write_fd = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, CLAUDE_PIPE_SIZE)
+        except OSError:
+            pass  # above /proc/sys/fs/pipe-max-size; keep the default
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.PIPE,
+            stdout=write_fd,
+            stderr=stderr,
+            cwd=scope,
+            env=CLAUDE_ENV,
+            limit=CLAUDE_STREAM_LIMIT,
+        )
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+
+    reader = asyncio.StreamReader(limit=CLAUDE_STREAM_LIMIT)
+    await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb", buffering=0)
+    )
+    return process, reader
+
+
+def session_args(session_id: str) -> list[str]:
+    """claude flags that pick up the stored conversation, if there is one."""
+    if not session_id:
+        return []
+    if session_id == CONTINUE_LAST:
+        return ["--continue"]
+    return ["--resume", session_id]
+
+
+class ClaudeSession:
+    """Long-lived claude process for one scope, fed one turn at a time over stdin.
+
+    Each user_message() is written to stdin and the turn is complete once the
+    "result" event is read back.
+    """
+
+    def __init__(self, scope: str):
+        self.scope = scope
+        self.session_id = None
+        self.proc = None
+        self.stdout = None
+        self.stderr_tail = deque(maxlen=CLAUDE_STDERR_LINES)
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+        self._reaper = None
+        self._stderr_task = None
+
+    async def start(self, session_id: str = None) -> None:
+        cmd = [CLAUDE_BIN, *CLAUDE_STREAM_ARGS, *session_args(session_id)]
+        self.session_id = session_id
+
+        self.proc, self.stdout = await spawn_claude_process(cmd, self.scope, subprocess.PIPE)
+        # Drain stderr all the time so it never fills its pipe; keep the tail for error messages
+        self._stderr_task = asyncio.create_task(self._drain_stderr())
+        self.last_used = time.monotonic()
+        self._reaper = asyncio.create_task(self._close_when_idle())
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def send(self, message: bytes, chat=None, on_text=None) -> str:
+        """Run one turn; BrokenPipeError means claude never received the message."""
+        async with self.lock:
+            if not self.is_alive():
+                raise BrokenPipeError("claude process is not running")
+            self.last_used = time.monotonic()
+            try:
+                self.proc.stdin.write(message)
+                # A failed write closes the transport instead of raising
+                if self.proc.stdin.is_closing():
+                    raise BrokenPipeError("claude process is not reading stdin")
+                await self.proc.stdin.drain()
+            except OSError as e:
+                raise BrokenPipeError("claude process is not reading stdin") from e
+
+            try:
+                event = await asyncio.wait_for(self._read_result(chat, on_text), timeout=CLAUDE_TIMEOUT)
+            except asyncio.TimeoutError:
+                await stop_process(self.proc)
+                await self.close()
+                raise
+
+            self.last_used = time.monotonic()
+            self.session_id = event.get("session_id") or self.session_id
+
+        if event.get("is_error"):
+            return f"Error calling Claude: {event.get('result', '')}"
+        return event.get("result", "")
+
+    async def close(self) -> None:
+        if SESSIONS.get(self.scope) is self:
+            del SESSIONS[self.scope]
+        if self._reaper and self._reaper is not asyncio.current_task():
+            self._reaper.cancel()
+        if not self.is_alive():
+            return
 
-        response = stdout.decode("utf-8", errors="replace")
+        self.proc.stdin.close()
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            await stop_process(self.proc)
+
+    async def stderr_text(self) -> str:
+        """The last lines claude wrote to stderr, waiting briefly for a dead process's final output."""
+        if self._stderr_task and not self.is_alive():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._stderr_task), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+        return "\n".join(self.stderr_tail)
+
+    async def _drain_stderr(self) -> None:
+        try:
+            async for line in self.proc.stderr:
+                line = line.decode("utf-8", errors="replace").rstrip()
+                if line:
+                    self.stderr_tail.append(line)
+                    logging.debug("claude stderr: %s", line)
+        except ValueError:
+            pass  # a line over CLAUDE_STREAM_LIMIT; nothing useful to keep
+
+    async def _read_result(self, chat=None, on_text=None) -> dict:
+        event = await read_result(self.stdout, chat, on_text)
+        if event is None:
+            raise ConnectionError("claude process exited mid-turn")
+        return event
+
+    async def _close_when_idle(self) -> None:
+        while self.is_alive():
+            idle = time.monotonic() - self.last_used
+            if idle >= CLAUDE_IDLE_TIMEOUT and not self.lock.locked():
+                await self.close()
+                return
+            await asyncio.sleep(max(CLAUDE_IDLE_TIMEOUT - idle, 1))
+
+
+# Persistent claude processes, keyed by scope
+SESSIONS: dict[str, ClaudeSession] = {}
+
+# One turn at a time per scope, so concurrent workers share one process and conversation
+SCOPE_LOCKS: defaultdict = defaultdict(asyncio.Lock)
+
+# Bumped on every scope or conversation switch
+SESSION_GENERATION = 0
+
+
+async def get_claude_session(scope: str, session_id: str) -> ClaudeSession:
+    session = SESSIONS.get(scope)
+    if session is None or not session.is_alive():
+        session = ClaudeSession(scope)
+        await session.start(session_id)
+        SESSIONS[scope] = session
+    return session
+
+
+async def close_claude_session(scope: str) -> None:
+    """Close the scope's process after the user switched scope or conversation."""
+    global SESSION_GENERATION
+    # Turns still in flight must not write their session id over the new choice
+    SESSION_GENERATION += 1
+    session = SESSIONS.get(scope)
+    if session:
+        await session.close()
+
+
+async def in_current_scope(run):
+    """Await run(scope) holding the current scope's lock."""
+    while True:
+        scope = SESSION_STATE.get("scope", DEFAULT_SCOPE)
+        async with SCOPE_LOCKS[scope]:
+            # The scope may have changed while we waited for the lock
+            if SESSION_STATE.get("scope", DEFAULT_SCOPE) == scope:
+                return await run(scope)
+
+
+async def call_claude(prompt: str, image: bytes = None, media_type: str = "image/jpeg", chat=None, on_text=None) -> str:
+    message = user_message(prompt, image, media_type)
+    return await in_current_scope(lambda scope: _claude_turn(scope, message, chat, on_text))
+
+
+async def _claude_turn(scope: str, message: bytes, chat=None, on_text=None) -> str:
+    """Run one message through claude in scope; the caller holds SCOPE_LOCKS[scope]."""
+    session_data = SESSION_STATE
+    session_id = session_data.get("session_id")
+    generation = SESSION_GENERATION
+
+    def remember(new_id):
+        # Skip the write if the user switched scope or conversation mid-turn
+        if generation == SESSION_GENERATION and new_id != session_data.get("session_id"):
+            session_data["session_id"] = new_id
+            save_session_data()
+
+    existing = SESSIONS.get(scope)
+    fresh = existing is None or not existing.is_alive()
+    try:
+        session = await get_claude_session(scope, session_id)
+    except OSError:
+        session = None
 
-        if not session_id:
-            session_data["session_id"] = "last"
-            save_session_data(session_data)
+    if session:
+        try:
+            response = await session.send(message, chat, on_text)
+        except asyncio.TimeoutError:
+            return f"Error: Claude timed out after {CLAUDE_TIMEOUT}s"
+        except BrokenPipeError:
+            await session.close()
+            if fresh:
+                # It died on startup (e.g. a stale --resume id); a retry would too
+                if session_id:
+                    remember(None)
+                error_msg = await session.stderr_text() or "claude exited on startup"
+                logging.warning("claude failed to start in %s: %s", scope, error_msg)
+                return f"Error calling Claude: {error_msg}"
+        except (OSError, ValueError) as e:
+            # claude already has the message, so running it again would repeat it
+            await session.close()
+            if fresh and session_id:
+                remember(None)
+            error_msg = await session.stderr_text() or str(e)
+            logging.warning("claude failed mid-turn in %s: %s", scope, error_msg)
+            return f"Error calling Claude: {error_msg}"
+        else:
+            remember(session.session_id)
+            return response
 
-        return response
+    # The persistent process was unusable before it got the message; run this turn one-shot
+    cmd = [CLAUDE_BIN, *CLAUDE_STREAM_ARGS, *session_args(session_id)]
 
+    try:
+        returncode, result, stderr = await _spawn_claude(cmd, scope, message, chat, on_text)
+    except asyncio.TimeoutError:
+        return f"Error: Claude timed out after {CLAUDE_TIMEOUT}s"
     except FileNotFoundError:
         return "Error: 'claude' command not found. Make sure Claude Code CLI is installed and in PATH."
     except Exception as e:
         return f"Error: {str(e)}"
 
+    if returncode != 0 or result is None:
+        # Don't retry here; the next message starts a fresh session instead
+        if session_id:
+            remember(None)
+        error_msg = (
+            (result or {}).get("result")
+            or stderr.decode("utf-8", errors="replace")
+            or f"claude exited with code {returncode}"
+        )
+        return f"Error calling Claude: {error_msg}"
+
+    if result.get("session_id"):
+        remember(result["session_id"])
+
+    if result.get("is_error"):
+        return f"Error calling Claude: {result.get('result', '')}"
+    return result.get("result", "")
 
-async def call_claude_new_session(prompt: str, image_path: str, scope: str) -> str:
-    cmd = ["claude"]
 
-    if image_path:
-        cmd.extend(["--image", image_path])
+async def _spawn_claude(cmd: list[str], scope: str, message: bytes, chat=None, on_text=None) -> tuple[int, dict | None, bytes]:
+    """Run a one-shot claude process on one message and return its exit code, result event and stderr."""
+    process, stdout = await spawn_claude_process(cmd, scope, subprocess.PIPE)
+    stderr_task = asyncio.create_task(process.stderr.read())
 
-    cmd.extend(["-p", prompt])
+    async def finish() -> bytes:
+        await stdout.read()
+        stderr = await stderr_task
+        await process.wait()
+        return stderr
 
     try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=scope,
-        )
-        stdout, stderr = await process.communicate()
+        process.stdin.write(message)
+        await process.stdin.drain()
+        process.stdin.close()
+
+        result = await asyncio.wait_for(read_result(stdout, chat, on_text), timeout=CLAUDE_TIMEOUT)
+        try:
+            stderr = await asyncio.wait_for(finish(), timeout=CLAUDE_EXIT_GRACE)
+        except asyncio.TimeoutError:
+            # Don't let a child slow to exit hold the scope's lock; an answer already read still counts
+            await stop_process(process)
+            return (0 if result is not None else process.returncode), result, b""
+    except BaseException:
+        # Timeout, an over-long stream line or cancellation: nobody will read claude's output now
+        await stop_process(process)
+        raise
+    finally:
+        stderr_task.cancel()
+    return process.returncode, result, stderr
 
-        if process.returncode != 0:
-            error_msg = stderr.decode("utf-8", errors="replace")
-            return f"Error: {error_msg}"
 
-        return stdout.decode("utf-8", errors="replace")
-    except Exception as e:
-        return f"Error: {str(e)}"
+_LAST_SEND: defaultdict = defaultdict(float)
+_GLOBAL_SEND = asyncio.Semaphore(GLOBAL_SEND_LIMIT)
+
+
+async def throttled_send(chat_id, coro):
+    """Await a Telegram send coroutine without exceeding Telegram's flood limits."""
+    # Reserve this chat's next slot before sleeping so concurrent sends queue up
+    now = time.monotonic()
+    slot = max(now, _LAST_SEND[chat_id] + CHAT_SEND_INTERVAL)
+    _LAST_SEND[chat_id] = slot
+    if slot > now:
+        await asyncio.sleep(slot - now)
+    async with _GLOBAL_SEND:
+        return await coro
 
 
 async def send_response(update: Update, response: str) -> None:
     if not response.strip():
         response = "(empty response)"
 
+    chat_id = update.effective_chat.id
     if len(response) <= TELEGRAM_MAX_LENGTH:
-        await update.message.reply_text(response)
+        await throttled_send(chat_id, update.message.reply_text(response))
     else:
-        with tempfile.NamedTemporaryFile(
-            mode="w",
-            suffix=".txt",
-            delete=False,
-            encoding="utf-8"
-        ) as f:
-            f.write(response)
-            temp_path = f.name
+        await throttled_send(chat_id, update.message.reply_document(
+            document=response.encode("utf-8"),
+            filename="response.txt",
+            caption=f"Response was too long ({len(response)} chars), sent as file."
+        ))
+
+
+class StreamingReply:
+    """One Telegram message showing claude's reply as it streams in, edited in place."""
 
+    def __init__(self, update: Update):
+        self.update = update
+        self.chat_id = update.effective_chat.id
+        self.message = None
+        self.shown = ""
+        self.last_edit = 0.0
+
+    async def show(self, text: str) -> None:
+        if time.monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        text = text.strip()
+        if len(text) > TELEGRAM_MAX_LENGTH:
+            text = text[:TELEGRAM_MAX_LENGTH - 1] + "…"
+        if not text or text == self.shown:
+            return
+
+        # Partial output is best effort; the final reply goes out in finish()
+        try:
+            if self.message is None:
+                self.message = await throttled_send(self.chat_id, self.update.message.reply_text(text))
+            else:
+                await throttled_send(self.chat_id, self.message.edit_text(text))
+        except TelegramError as e:
+            logging.debug("stream update failed: %s", e)
+            return
+        self.shown = text
+        self.last_edit = time.monotonic()
+
+    async def finish(self, response: str) -> None:
+        if self.message is None:
+            await send_response(self.update, response)
+        elif response.strip() and len(response) <= TELEGRAM_MAX_LENGTH:
+            if response.strip() != self.shown:
+                await throttled_send(self.chat_id, self.message.edit_text(response))
+        else:
+            await self.message.delete()
+            await send_response(self.update, response)
+
+
+class ClaudeJob(NamedTuple):
+    update: Update
+    prompt: str
+    image: bytes = None
+    media_type: str = "image/jpeg"
+    # A scope or session change to run in turn instead of a prompt
+    switch: Callable[[], Awaitable[None]] = None
+
+
+CLAUDE_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=CLAUDE_QUEUE_SIZE)
+_WORKER_TASKS: list[asyncio.Task] = []
+
+
+async def claude_worker(app: Application) -> None:
+    """Take jobs off the queue, run claude and reply, until cancelled."""
+    while True:
+        job = await CLAUDE_QUEUE.get()
         try:
-            with open(temp_path, "rb") as f:
-                await update.message.reply_document(
-                    document=f,
-                    filename="response.txt",
-                    caption=f"Response was too long ({len(response)} chars), sent as file."
-                )
+            if job.switch:
+                # Holding the scope's lock means no turn is running when the session closes
+                await in_current_scope(lambda scope: job.switch())
+                continue
+            reply = StreamingReply(job.update)
+            response = await call_claude(job.prompt, job.image, job.media_type, job.update.message.chat, reply.show)
+            await reply.finish(response)
+        except Exception as e:
+            await app.process_error(job.update, e)
         finally:
-            os.unlink(temp_path)
+            CLAUDE_QUEUE.task_done()
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_allowed_user(update):
-        return
-
     message_text = update.message.text
-    print(f"Received message: {message_text[:100]}...")
+    logging.info("Received message: %s...", message_text[:100])
 
-    await update.message.chat.send_action("typing")
+    send_typing(update.message.chat)
+    await CLAUDE_QUEUE.put(ClaudeJob(update, message_text))
 
-    response = await call_claude(message_text)
-    await send_response(update, response)
 
+async def _process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str, media_type: str, caption: str) -> None:
+    """Download an image into memory and queue it for claude with its caption."""
+    chat_id = update.effective_chat.id
+    if media_type not in CLAUDE_IMAGE_TYPES:
+        await throttled_send(chat_id, update.message.reply_text(
+            f"Unsupported image type ({media_type}). Send JPEG, PNG, GIF or WebP."
+        ))
+        return
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_allowed_user(update):
+    send_typing(update.message.chat)
+    file = await context.bot.get_file(file_id)
+    # Telegram usually reports the size, which saves downloading an image we'd reject
+    image = None if file.file_size and file.file_size > MAX_IMAGE_SIZE else await file.download_as_bytearray()
+    if image is None or len(image) > MAX_IMAGE_SIZE:
+        size = file.file_size if image is None else len(image)
+        await throttled_send(chat_id, update.message.reply_text(
+            f"Image too large ({size // 1024}KB). Claude accepts images up to {MAX_IMAGE_SIZE // 1024}KB."
+        ))
         return
 
+    await CLAUDE_QUEUE.put(ClaudeJob(update, caption, image, media_type))
+
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     photo = update.message.photo[-1]
     caption = update.message.caption or "What's in this image?"
 
-    print(f"Received photo with caption: {caption[:100]}...")
+    logging.info("Received photo with caption: %s...", caption[:100])
 
-    file = await context.bot.get_file(photo.file_id)
-    image_path = TEMP_DIR / f"{photo.file_id}.jpg"
-    await file.download_to_drive(image_path)
+    await _process_image(update, context, photo.file_id, "image/jpeg", caption)
 
-    try:
-        await update.message.chat.send_action("typing")
-        response = await call_claude(caption, str(image_path))
-        await send_response(update, response)
-    finally:
-        if image_path.exists():
-            image_path.unlink()
 
+async def handle_image_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    document = update.message.document
+    caption = update.message.caption or "What's in this image?"
+    logging.info("Received image document")
+
+    await _process_image(update, context, document.file_id, document.mime_type, caption)
 
-async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_allowed_user(update):
-        return
 
+async def handle_other_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     document = update.message.document
+    caption = update.message.caption or f"Received file: {document.file_name}"
+    send_typing(update.message.chat)
+    await CLAUDE_QUEUE.put(ClaudeJob(update, caption))
 
-    if document.mime_type and document.mime_type.startswith("image/"):
-        caption = update.message.caption or "What's in this image?"
-        print(f"Received image document")
 
-        file = await context.bot.get_file(document.file_id)
-        extension = document.file_name.split(".")[-1] if document.file_name else "jpg"
-        image_path = TEMP_DIR / f"{document.file_id}.{extension}"
-        await file.download_to_drive(image_path)
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(
+        TPL_START.format_map(status_fields()),
+        parse_mode="Markdown",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-        try:
-            await update.message.chat.send_action("typing")
-            response = await call_claude(caption, str(image_path))
-            await send_response(update, response)
-        finally:
-            if image_path.exists():
-                image_path.unlink()
-    else:
-        caption = update.message.caption or f"Received file: {document.file_name}"
-        await update.message.chat.send_action("typing")
-        response = await call_claude(caption)
-        await send_response(update, response)
 
+async def unauthorized_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("Sorry, you are not authorized to use this bot.")
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_allowed_user(update):
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
 
-    session_data = load_session_data()
-    scope = session_data.get('scope', DEFAULT_SCOPE)
-    has_session = session_data.get("session_id") is not None
+async def _menu_main(query, update: Update) -> None:
+    await query.edit_message_text(
+        TPL_MAIN.format_map(status_fields()),
+        parse_mode="Markdown",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    await update.message.reply_text(
-        f"🤖 *Claude Code Bot*\n\n"
-        f"📁 Scope: `{scope}`\n"
-        f"💬 Session: {'active' if has_session else 'none'}\n\n"
-        f"Send any message to chat with Claude.\n"
-        f"Use /send <file> to get files.",
+
+async def _menu_scope(query, update: Update) -> None:
+    await query.edit_message_text(
+        TPL_SCOPE_MENU.format_map(status_fields()),
         parse_mode="Markdown",
-        reply_markup=get_main_keyboard()
+        reply_markup=SCOPE_KEYBOARD
     )
 
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle all button callbacks."""
-    query = update.callback_query
+async def _menu_session(query, update: Update) -> None:
+    await query.edit_message_text(
+        TPL_SESSION_MENU.format_map(status_fields()),
+        parse_mode="Markdown",
+        reply_markup=SESSION_KEYBOARD
+    )
 
-    if not is_allowed_user(update):
-        await query.answer("Not authorized")
-        return
 
-    await query.answer()
-    data = query.data
+async def _scope_preset(query, update: Update) -> None:
+    preset = query.data.removeprefix(CB_SCOPE_PREFIX)
+    session_data = SESSION_STATE
 
-    # Menu navigation
-    if data == "menu_main":
-        session_data = load_session_data()
-        scope = session_data.get('scope', DEFAULT_SCOPE)
-        has_session = session_data.get("session_id") is not None
+    if preset == "new":
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        new_scope = os.path.join(SCOPE_PRESETS["desktop"], f"claude_project_{timestamp}")
+        await asyncio.to_thread(os.makedirs, new_scope, exist_ok=True)
+        valid = True
+    else:
+        new_scope = SCOPE_PRESETS.get(preset, DEFAULT_SCOPE)
+        valid = SCOPE_PRESET_VALID.get(preset)
+        if valid is None:
+            valid = await asyncio.to_thread(os.path.isdir, new_scope)
+
+    if valid:
+        await close_claude_session(session_data.get("scope", DEFAULT_SCOPE))
+        session_data["scope"] = new_scope
+        session_data["session_id"] = None
+        session_data.pop("last_session_id", None)
+        save_session_data()
 
         await query.edit_message_text(
-            f"🤖 *Claude Code Bot*\n\n"
-            f"📁 Scope: `{scope}`\n"
-            f"💬 Session: {'active' if has_session else 'none'}\n\n"
-            f"Send any message to chat with Claude.",
+            f"✅ *Scope Updated*\n\n"
+            f"📁 `{new_scope}`\n\n"
+            f"Session reset for new scope.",
             parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
-
-    elif data == "menu_scope":
-        session_data = load_session_data()
-        scope = session_data.get('scope', DEFAULT_SCOPE)
-
+    else:
         await query.edit_message_text(
-            f"📁 *Select Scope*\n\n"
-            f"Current: `{scope}`\n\n"
-            f"Choose a preset or use /scope <path>",
-            parse_mode="Markdown",
-            reply_markup=get_scope_keyboard()
+            f"❌ Directory not found: {new_scope}",
+            reply_markup=SCOPE_KEYBOARD
         )
 
-    elif data == "menu_session":
-        session_data = load_session_data()
-        has_session = session_data.get("session_id") is not None
 
-        await query.edit_message_text(
-            f"🔄 *Session Control*\n\n"
-            f"Status: {'active' if has_session else 'none'}\n\n"
-            f"• *New Session* - start fresh\n"
-            f"• *Resume Last* - continue previous",
-            parse_mode="Markdown",
-            reply_markup=get_session_keyboard()
-        )
+async def _session_clear(query, update: Update) -> None:
+    session_data = SESSION_STATE
+    # Keep the id around so "Resume Last" can go back to it
+    if session_data.get("session_id"):
+        session_data["last_session_id"] = session_data["session_id"]
+    session_data["session_id"] = None
+    save_session_data()
+    await close_claude_session(session_data.get("scope", DEFAULT_SCOPE))
 
-    # Scope actions
-    elif data.startswith("scope_"):
-        preset = data.replace("scope_", "")
-        session_data = load_session_data()
+    await query.edit_message_text(
+        f"✅ *Session Cleared*\n\n"
+        f"Next message will start a fresh conversation.",
+        parse_mode="Markdown",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-        if preset == "new":
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            new_scope = os.path.join(SCOPE_PRESETS["desktop"], f"claude_project_{timestamp}")
-            os.makedirs(new_scope, exist_ok=True)
-        else:
-            new_scope = SCOPE_PRESETS.get(preset, DEFAULT_SCOPE)
-
-        if os.path.isdir(new_scope):
-            session_data["scope"] = new_scope
-            session_data["session_id"] = None
-            save_session_data(session_data)
-
-            await query.edit_message_text(
-                f"✅ *Scope Updated*\n\n"
-                f"📁 `{new_scope}`\n\n"
-                f"Session reset for new scope.",
-                parse_mode="Markdown",
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            await query.edit_message_text(
-                f"❌ Directory not found: {new_scope}",
-                reply_markup=get_scope_keyboard()
-            )
 
-    # Session actions
-    elif data == "session_clear":
-        session_data = load_session_data()
-        session_data["session_id"] = None
-        save_session_data(session_data)
+async def _session_resume(query, update: Update) -> None:
+    session_data = SESSION_STATE
+    session_data["session_id"] = (
+        session_data.get("session_id") or session_data.get("last_session_id") or CONTINUE_LAST
+    )
+    save_session_data()
+    await close_claude_session(session_data.get("scope", DEFAULT_SCOPE))
 
-        await query.edit_message_text(
-            f"✅ *Session Cleared*\n\n"
-            f"Next message will start a fresh conversation.",
-            parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
-        )
+    await query.edit_message_text(
+        f"✅ *Session Resumed*\n\n"
+        f"Continuing last conversation.",
+        parse_mode="Markdown",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    elif data == "session_resume":
-        session_data = load_session_data()
-        session_data["session_id"] = "last"
-        save_session_data(session_data)
 
-        await query.edit_message_text(
-            f"✅ *Session Resumed*\n\n"
-            f"Continuing last conversation.",
-            parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
-        )
+async def _action_status(query, update: Update) -> None:
+    await query.edit_message_text(
+        TPL_STATUS.format_map(status_fields()),
+        parse_mode="Markdown",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    # Actions
-    elif data == "action_status":
-        session_data = load_session_data()
-        scope = session_data.get('scope', DEFAULT_SCOPE)
-        has_session = session_data.get("session_id") is not None
 
-        await query.edit_message_text(
-            f"📊 *Status*\n\n"
-            f"📁 Scope: `{scope}`\n"
-            f"💬 Session: {'active' if has_session else 'none'}",
-            parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
-        )
+async def _action_myid(query, update: Update) -> None:
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    username = update.effective_user.username
 
-    elif data == "action_myid":
-        chat_id = update.effective_chat.id
-        user_id = update.effective_user.id
-        username = update.effective_user.username
+    await query.edit_message_text(
+        f"🆔 *Your Info*\n\n"
+        f"Chat ID: `{chat_id}`\n"
+        f"User ID: `{user_id}`\n"
+        f"Username: @{username}\n\n"
+        f"Add to .env:\n"
+        f"`OWNER_CHAT_ID={chat_id}`",
+        parse_mode="Markdown",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-        await query.edit_message_text(
-            f"🆔 *Your Info*\n\n"
-            f"Chat ID: `{chat_id}`\n"
-            f"User ID: `{user_id}`\n"
-            f"Username: @{username}\n\n"
-            f"Add to .env:\n"
-            f"`OWNER_CHAT_ID={chat_id}`",
-            parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
-        )
 
+# Button callback_data -> handler; scope_* buttons share _scope_preset
+CALLBACK_HANDLERS = {
+    CB_MENU_MAIN: _menu_main,
+    CB_MENU_SCOPE: _menu_scope,
+    CB_MENU_SESSION: _menu_session,
+    CB_SESSION_CLEAR: _session_clear,
+    CB_SESSION_RESUME: _session_resume,
+    CB_ACTION_STATUS: _action_status,
+    CB_ACTION_MYID: _action_myid,
+}
+
+# These change the scope or conversation, so they wait behind messages sent before them
+SWITCH_HANDLERS = (_scope_preset, _session_clear, _session_resume)
+
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle all button callbacks."""
+    query = update.callback_query
 
-async def send_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle /send command - send a file to user."""
     if not is_allowed_user(update):
+        await query.answer("Not authorized")
         return
 
+    await query.answer()
+    data = query.data
+
+    handler = CALLBACK_HANDLERS.get(data)
+    if handler is None and data.startswith(CB_SCOPE_PREFIX):
+        handler = _scope_preset
+    if handler in SWITCH_HANDLERS:
+        await CLAUDE_QUEUE.put(ClaudeJob(update, None, switch=lambda: handler(query, update)))
+    elif handler:
+        await handler(query, update)
+
+
+async def send_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /send command - send a file to user."""
+    chat_id = update.effective_chat.id
+
     if not context.args:
-        await update.message.reply_text("Usage: /send <file_path>\n\nExample: /send file.txt")
+        await throttled_send(chat_id, update.message.reply_text("Usage: /send <file_path>\n\nExample: /send file.txt"))
         return
 
     file_path = " ".join(context.args)
-    session_data = load_session_data()
+    session_data = SESSION_STATE
     scope = session_data.get("scope", DEFAULT_SCOPE)
 
     if not os.path.isabs(file_path):
         file_path = os.path.join(scope, file_path)
 
-    if not os.path.exists(file_path):
-        await update.message.reply_text(f"File not found: {file_path}")
+    # One stat off the event loop answers exists, is-a-file and size
+    try:
+        st = await asyncio.to_thread(os.stat, file_path)
+    except OSError:
+        await throttled_send(chat_id, update.message.reply_text(f"File not found: {file_path}"))
         return
 
-    if not os.path.isfile(file_path):
-        await update.message.reply_text(f"Not a file: {file_path}")
+    if not stat.S_ISREG(st.st_mode):
+        await throttled_send(chat_id, update.message.reply_text(f"Not a file: {file_path}"))
         return
 
     try:
-        file_size = os.path.getsize(file_path)
+        file_size = st.st_size
         if file_size > 50 * 1024 * 1024:
-            await update.message.reply_text(f"File too large ({file_size // (1024*1024)}MB). Telegram limit is 50MB.")
+            await throttled_send(chat_id, update.message.reply_text(f"File too large ({file_size // (1024*1024)}MB). Telegram limit is 50MB."))
             return
 
         file_name = os.path.basename(file_path)
-        image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
-        ext = os.path.splitext(file_name)[1].lower()
 
-        with open(file_path, "rb") as f:
-            if ext in image_extensions:
-                await update.message.reply_photo(photo=f, caption=file_name)
-            else:
-                await update.message.reply_document(document=f, filename=file_name)
+        # PTB reads any file object (an mmap included) into bytes on the event loop,
+        # so do that single read in a thread and hand it the bytes
+        data = await asyncio.to_thread(Path(file_path).read_bytes)
+        if file_name.lower().endswith(IMAGE_SUFFIXES):
+            await throttled_send(chat_id, update.message.reply_photo(photo=data, caption=file_name, filename=file_name))
+        else:
+            await throttled_send(chat_id, update.message.reply_document(document=data, filename=file_name))
 
     except Exception as e:
-        await update.message.reply_text(f"Error sending file: {str(e)}")
+        await throttled_send(chat_id, update.message.reply_text(f"Error sending file: {str(e)}"))
 
 
 async def scope_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /scope command with path argument."""
-    if not is_allowed_user(update):
-        return
-
     if not context.args:
-        session_data = load_session_data()
+        session_data = SESSION_STATE
         await update.message.reply_text(
             f"📁 Current scope: {session_data.get('scope', DEFAULT_SCOPE)}\n\n"
             f"Use buttons or /scope <path>",
-            reply_markup=get_scope_keyboard()
+            reply_markup=SCOPE_KEYBOARD
         )
         return
 
     new_scope = os.path.expanduser(" ".join(context.args))
 
-    if not os.path.isdir(new_scope):
+    if not await asyncio.to_thread(os.path.isdir, new_scope):
         await update.message.reply_text(f"Error: '{new_scope}' is not a valid directory.")
         return
 
-    session_data = load_session_data()
-    session_data["scope"] = new_scope
-    session_data["session_id"] = None
-    save_session_data(session_data)
-
-    await update.message.reply_text(
-        f"✅ Scope set to: {new_scope}\nSession reset.",
-        reply_markup=get_main_keyboard()
-    )
+    async def switch() -> None:
+        session_data = SESSION_STATE
+        await close_claude_session(session_data.get("scope", DEFAULT_SCOPE))
+        session_data["scope"] = new_scope
+        session_data["session_id"] = None
+        session_data.pop("last_session_id", None)
+        save_session_data()
 
+        await update.message.reply_text(
+            f"✅ Scope set to: {new_scope}\nSession reset.",
+            reply_markup=MAIN_KEYBOARD
+        )
 
-async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    import traceback
+    # Messages sent before /scope still run in the old scope
+    await CLAUDE_QUEUE.put(ClaudeJob(update, None, switch=switch))
 
-    error_msg = f"Error: {context.error}\n\n"
-    error_msg += "".join(traceback.format_exception(type(context.error), context.error, context.error.__traceback__))
 
-    print(f"Error occurred: {context.error}")
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logging.error("Error occurred: %s", context.error)
 
     if OWNER_CHAT_ID:
+        # Format the traceback lazily and stop once the message is full
+        limit = TELEGRAM_MAX_LENGTH - 100
+        parts = []
+        length = 0
+        chunks = itertools.chain(
+            [f"Error: {context.error}\n\n"],
+            traceback.TracebackException.from_exception(context.error).format(),
+        )
+        for chunk in chunks:
+            if length + len(chunk) > limit:
+                parts.append(chunk[:limit - length])
+                parts.append("\n\n... (truncated)")
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        error_msg = "".join(parts)
+
         try:
-            if len(error_msg) > TELEGRAM_MAX_LENGTH:
-                error_msg = error_msg[:TELEGRAM_MAX_LENGTH - 100] + "\n\n... (truncated)"
-            await context.bot.send_message(chat_id=OWNER_CHAT_ID, text=f"🚨 Bot Error:\n{error_msg}")
+            await throttled_send(
+                OWNER_CHAT_ID,
+                context.bot.send_message(chat_id=OWNER_CHAT_ID, text=f"🚨 Bot Error:\n{error_msg}"),
+            )
         except Exception as e:
-            print(f"Failed to send error notification: {e}")
+            logging.error("Failed to send error notification: %s", e)
+
+
+async def post_init(app: Application) -> None:
+    """Start the claude workers once the event loop is running."""
+    for _ in range(CLAUDE_WORKERS):
+        _WORKER_TASKS.append(asyncio.create_task(claude_worker(app)))
+
+
+async def post_shutdown(app: Application) -> None:
+    """Stop the claude workers and processes and write out any pending session change."""
+    for task in _WORKER_TASKS:
+        task.cancel()
+    await asyncio.gather(*_WORKER_TASKS, return_exceptions=True)
+    # Otherwise a claude mid-turn keeps running its tools after the bot exits
+    await asyncio.gather(*(session.close() for session in list(SESSIONS.values())), return_exceptions=True)
+    async with _SESSION_LOCK:
+        if _SESSION_DIRTY:
+            await asyncio.to_thread(_save_session_sync, _session_payload())
 
 
 def main():
+    setup_logging()
+    SESSION_STATE.update(load_session_data())
+
     if not TELEGRAM_BOT_TOKEN:
-        print("Error: TELEGRAM_BOT_TOKEN not set in .env file")
+        logging.error("TELEGRAM_BOT_TOKEN not set in .env file")
         return
 
-    print(f"Starting bot... Only responding to @{ALLOWED_USERNAME}")
-    print(f"Default scope: {DEFAULT_SCOPE}")
-    print("Press Ctrl+C to stop")
+    logging.info("Starting bot... Only responding to @%s", ALLOWED_USERNAME)
+    logging.info("Default scope: %s", DEFAULT_SCOPE)
+    logging.info("Press Ctrl+C to stop")
 
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # libuv-backed loop; Windows keeps the default Proactor loop for subprocesses
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logging.info("uvloop not installed, using the default event loop")
+
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # One shared HTTP/2 pool so concurrent replies multiplex over a single connection
+        .http_version("2")
+        .connection_pool_size(64)
+        .pool_timeout(5)
+        .connect_timeout(5)
+        .read_timeout(30)
+        .get_updates_connection_pool_size(2)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    # Command handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("send", send_file_cmd))
-    app.add_handler(CommandHandler("scope", scope_cmd))
+    # Command handlers; updates from anyone else never reach the handler code
+    app.add_handler(CommandHandler("start", start, filters=ALLOWED_USER))
+    app.add_handler(CommandHandler("start", unauthorized_start, filters=~ALLOWED_USER))
+    app.add_handler(CommandHandler("send", send_file_cmd, filters=ALLOWED_USER))
+    app.add_handler(CommandHandler("scope", scope_cmd, filters=ALLOWED_USER))
 
-    # Button handler
+    # Button handler (CallbackQueryHandler takes no filters, so it checks the user itself)
     app.add_handler(CallbackQueryHandler(button_handler))
 
     # Message handlers
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    app.add_handler(MessageHandler(ALLOWED_USER & filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(MessageHandler(ALLOWED_USER & filters.PHOTO, handle_photo))
+    app.add_handler(MessageHandler(ALLOWED_USER & filters.Document.IMAGE, handle_image_document))
+    app.add_handler(MessageHandler(ALLOWED_USER & filters.Document.ALL & ~filters.Document.IMAGE, handle_other_document))
 
     app.add_error_handler(error_handler)
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 
 
 if __name__ == "__main__":